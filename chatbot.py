@@ -1,24 +1,31 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
 from langchain.retrievers.multi_query import MultiQueryRetriever
 from langchain_chroma import Chroma
+from langchain_community.cache import SQLiteCache
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.globals import set_llm_cache
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.pydantic_v1 import BaseModel
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.runnables import RunnablePassthrough
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyParameters, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import ContextTypes
 
 from config import config
 from database_handler import DatabaseHandler
-from document_processor import DocumentProcessor
+from document_processor import DocumentProcessor, EmbeddingsProvider
 from logger import logger
 
 
-class Question(BaseModel):
-    __root__: str
-
-
 class PromptCreator:
     @staticmethod
     def create_prompt() -> ChatPromptTemplate:
@@ -26,6 +33,12 @@ class PromptCreator:
 
 
 class LLMProvider:
+    CACHE_DATABASE_PATH = ".llm_cache.db"
+
+    @staticmethod
+    def setup_cache() -> None:
+        set_llm_cache(SQLiteCache(database_path=LLMProvider.CACHE_DATABASE_PATH))
+
     @staticmethod
     def create_llm() -> ChatGoogleGenerativeAI:
         return ChatOpenAI(
@@ -33,6 +46,10 @@ class LLMProvider:
             max_retries=16,
             timeout=120,
             model="gpt-4o",
+            api_key=config.OPENAI_API_KEY,
+            # Only non-streaming calls read the LLM cache, i.e. the MultiQuery rewrites. Answers are streamed,
+            # which bypasses it, and are cached by SemanticCache instead
+            cache=True,
         )
 
 
@@ -40,8 +57,10 @@ class VectorStoreProvider:
     @staticmethod
     def create_vectorstore() -> Chroma:
         return Chroma(
+            collection_name=DocumentProcessor.COLLECTION_NAME,
             persist_directory=DocumentProcessor.PERSIST_DIRECTORY,
-            embedding_function=OpenAIEmbeddings(
+            embedding_function=EmbeddingsProvider.create_embeddings(
+                api_key=config.OPENAI_API_KEY,
                 retry_max_seconds=120,
                 show_progress_bar=True,
                 max_retries=10,
@@ -49,43 +68,95 @@ class VectorStoreProvider:
         )
 
 
+class CachedMultiQueryRetriever(MultiQueryRetriever):
+    cache_size: int = 2048
+    _query_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+
+    async def agenerate_queries(self, question: str, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[str]:
+        queries = self._query_cache.get(question)
+        if queries is None:
+            queries = await super().agenerate_queries(question, run_manager)
+            self._query_cache[question] = queries
+            if len(self._query_cache) > self.cache_size:
+                self._query_cache.popitem(last=False)
+        else:
+            self._query_cache.move_to_end(question)
+        # The caller may append the original query, so never hand out the cached list itself
+        return list(queries)
+
+
 class RetrieverProvider:
     @staticmethod
     def create_retriever(vectorstore: Chroma, llm: ChatGoogleGenerativeAI) -> MultiQueryRetriever:
-        return MultiQueryRetriever.from_llm(vectorstore.as_retriever(k=5), llm)
+        return CachedMultiQueryRetriever.from_llm(vectorstore.as_retriever(k=5), llm)
 
 
 class ProcessingChain:
     @staticmethod
     def create_chain(prompt: ChatPromptTemplate, llm: ChatGoogleGenerativeAI, retriever: MultiQueryRetriever):
-        chain = (
-            RunnableParallel({"context": retriever, "question": RunnablePassthrough()})
-            | prompt
-            | llm
-            | StrOutputParser()
+        return {"context": retriever, "question": RunnablePassthrough()} | prompt | llm | StrOutputParser()
+
+
+class SemanticCache:
+    COLLECTION_NAME = DocumentProcessor.SEMANTIC_CACHE_COLLECTION_NAME
+
+    def __init__(self, embedding_function: Embeddings, threshold: float):
+        self.threshold = threshold
+        self.vectorstore = Chroma(
+            collection_name=SemanticCache.COLLECTION_NAME,
+            persist_directory=DocumentProcessor.PERSIST_DIRECTORY,
+            embedding_function=embedding_function,
+            collection_metadata={"hnsw:space": "cosine"},
         )
-        return chain.with_types(input_type=Question)
+
+    async def get(self, text: str) -> Optional[str]:
+        results = await self.vectorstore.asimilarity_search_with_relevance_scores(text, k=1)
+        if not results:
+            return None
+
+        document, score = results[0]
+        if score < self.threshold:
+            return None
+
+        logger.info(f"Semantic cache hit ({score:.3f}) for query: {text}")
+        return document.metadata["response"]
+
+    async def put(self, text: str, response: str) -> None:
+        await self.vectorstore.aadd_texts([text], metadatas=[{"response": response}])
 
 
 class ChatBot:
+    FEEDBACK_QUESTION = "Этот ответ был полезен?"
+    FEEDBACK_STATS_TEMPLATE = FEEDBACK_QUESTION + "\n\n👍 {useful_count} | 👎 {not_useful_count}"
+    FEEDBACK_BUTTONS = (("👍", "like"), ("👎", "dislike"))
+    FEEDBACK_DATA_PATTERN = re.compile(r"(like|dislike):(\d{1,19})")
+    STREAM_EDIT_INTERVAL = 1.0
+    FINAL_EDIT_ATTEMPTS = 3
+    EMPTY_RESPONSE_TEXT = "Я пока не могу ответить на это"
+    PROMPT = PromptCreator.create_prompt()
+    LLM = LLMProvider.create_llm()
+
     def __init__(self):
+        self._initialized = False
         self.db_handler = None
-        self.prompt = None
-        self.llm = None
         self.vectorstore = None
         self.retriever = None
         self.chain = None
-        self.allowed_chat_ids = [int(chat_id) for chat_id in config.ALLOWED_CHAT_IDS.split(",") if chat_id]
-        self.allowed_thread_ids = [int(thread_id) for thread_id in config.ALLOWED_THREADS_IDS.split(",") if thread_id]
+        self.semantic_cache = None
+        self.allowed_chat_ids = config.ALLOWED_CHAT_IDS
+        self.allowed_thread_ids = config.ALLOWED_THREADS_IDS
 
     async def initialize(self, db_handler: DatabaseHandler):
+        if self._initialized:
+            return
         self.db_handler = db_handler
         await self.db_handler.initialize()
-        self.prompt = PromptCreator.create_prompt()
-        self.llm = LLMProvider.create_llm()
+        LLMProvider.setup_cache()
         self.vectorstore = VectorStoreProvider.create_vectorstore()
-        self.retriever = RetrieverProvider.create_retriever(self.vectorstore, self.llm)
-        self.chain = ProcessingChain.create_chain(self.prompt, self.llm, self.retriever)
+        self.retriever = RetrieverProvider.create_retriever(self.vectorstore, self.LLM)
+        self.chain = ProcessingChain.create_chain(self.PROMPT, self.LLM, self.retriever)
+        self.semantic_cache = SemanticCache(self.vectorstore.embeddings, config.SEMANTIC_CACHE_THRESHOLD)
+        self._initialized = True
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_id = update.message.chat.id
@@ -140,17 +211,19 @@ class ChatBot:
 
         await self._send_typing_action(context, chat_id, thread_id)
 
-        response = await self.chain.ainvoke(
-            text,
-            config={"configurable": {"search_kwargs": {"namespace": ""}}},
-        )
+        reply_to_message_id = update.message.message_id
+        response = await self.semantic_cache.get(text)
+        if response is not None:
+            message = await self._send_response_message(context, chat_id, thread_id, response, reply_to_message_id)
+        else:
+            message, response = await self._stream_response_message(
+                context, chat_id, thread_id, text, reply_to_message_id
+            )
+            await self.semantic_cache.put(text, response)
 
         logger.info(f"User query: {text}")
         logger.info(f"AI response: {response}")
 
-        reply_to_message_id = update.message.message_id
-        message = await self._send_response_message(context, chat_id, thread_id, response, reply_to_message_id)
-
         await self.db_handler.store_response(message.message_id, response)
 
         await self._send_feedback_buttons(context, chat_id, thread_id, message.message_id)
@@ -190,17 +263,67 @@ class ChatBot:
             parse_mode="Markdown",
         )
 
+    async def _stream_response_message(self, context, chat_id, thread_id, text, reply_to_message_id):
+        message = await self._send_response_message(context, chat_id, thread_id, "…", reply_to_message_id)
+
+        chunks = []
+        last_edit = time.monotonic()
+        async for chunk in self.chain.astream(
+            text,
+            config={"configurable": {"search_kwargs": {"namespace": ""}}},
+        ):
+            chunks.append(chunk)
+            if time.monotonic() - last_edit < self.STREAM_EDIT_INTERVAL:
+                continue
+            partial = "".join(chunks).strip()
+            if partial:
+                # Partial Markdown may be unbalanced, so intermediate edits go out as plain text
+                try:
+                    await message.edit_text(f"{partial} …")
+                except RetryAfter as e:
+                    # Flood control: hold further progress edits back until Telegram accepts them again
+                    logger.warning(f"Streaming edit throttled, pausing edits for {e.retry_after}s")
+                    last_edit = time.monotonic() + e.retry_after
+                    continue
+                except TelegramError as e:
+                    # A failed progress update is harmless; the final edit still delivers the full answer
+                    logger.warning(f"Streaming edit failed: {e}")
+                last_edit = time.monotonic()
+
+        response = "".join(chunks).strip() or self.EMPTY_RESPONSE_TEXT
+        await self._finish_response_message(message, response)
+        return message, response
+
+    async def _finish_response_message(self, message, response):
+        parse_mode = "Markdown"
+        for attempt in range(1, self.FINAL_EDIT_ATTEMPTS + 1):
+            try:
+                await message.edit_text(response, parse_mode=parse_mode)
+                return
+            except RetryAfter as e:
+                if attempt == self.FINAL_EDIT_ATTEMPTS:
+                    raise
+                logger.warning(f"Final edit throttled, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if parse_mode is None:
+                    raise
+                # The model's Markdown is not always valid for Telegram; the answer is still worth delivering
+                logger.warning(f"Markdown rejected in final edit, sending plain text: {e}")
+                parse_mode = None
+
     async def _send_feedback_buttons(self, context, chat_id, thread_id, message_id):
-        keyboard = [
+        reply_markup = InlineKeyboardMarkup(
             [
-                InlineKeyboardButton("👍", callback_data=f"like:{message_id}"),
-                InlineKeyboardButton("👎", callback_data=f"dislike:{message_id}"),
+                [
+                    InlineKeyboardButton(text, callback_data=f"{feedback}:{message_id}")
+                    for text, feedback in self.FEEDBACK_BUTTONS
+                ]
             ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        )
         await context.bot.send_message(
             chat_id=chat_id,
-            text="Этот ответ был полезен?",
+            text=self.FEEDBACK_QUESTION,
             reply_markup=reply_markup,
             message_thread_id=thread_id,
         )
@@ -216,7 +339,9 @@ class ChatBot:
         await self.db_handler.update_feedback(message_id, user_id, feedback)
         useful_count, not_useful_count, response = await self.db_handler.get_feedback(message_id)
 
-        feedback_message = f"Этот ответ был полезен?\n\n👍 {useful_count} | 👎 {not_useful_count}"
+        feedback_message = self.FEEDBACK_STATS_TEMPLATE.format_map(
+            {"useful_count": useful_count, "not_useful_count": not_useful_count}
+        )
 
         await query.edit_message_text(text=feedback_message, reply_markup=query.message.reply_markup)
 
@@ -227,13 +352,11 @@ class ChatBot:
         await query.answer("Спасибо за фидбэк!")
 
     def _parse_feedback(self, query):
-        try:
-            feedback, message_id = query.data.split(":")
-            message_id = int(message_id)
-            return feedback, message_id
-        except ValueError:
+        match = self.FEEDBACK_DATA_PATTERN.fullmatch(query.data or "")
+        if match is None:
             logger.error(f"Invalid callback data: {query.data}")
             return None, None
+        return match.group(1), int(match.group(2))
 
     async def handle_stats_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_id = update.message.chat.id
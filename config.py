@@ -1,18 +1,19 @@
-import os
+from typing import Annotated, Optional
 
-from dotenv import load_dotenv
-from pydantic_settings import BaseSettings
-
-load_dotenv()
+from pydantic import Field, field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
 
 
 class Config(BaseSettings):
-    ADMIN_CHAT_ID: str = os.getenv("ADMIN_CHAT_ID")
-    GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY")
-    OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
-    TELEGRAM_BOT_TOKEN: str = os.getenv("TELEGRAM_BOT_TOKEN")
-    ALLOWED_CHAT_IDS: str = os.getenv("ALLOWED_CHAT_IDS", "")
-    ALLOWED_THREADS_IDS: str = os.getenv("ALLOWED_THREADS_IDS", "")
+    model_config = SettingsConfigDict(env_file=".env", frozen=True, extra="ignore")
+
+    ADMIN_CHAT_ID: str
+    GOOGLE_API_KEY: Optional[str] = None
+    OPENAI_API_KEY: str
+    TELEGRAM_BOT_TOKEN: str
+    ALLOWED_CHAT_IDS: Annotated[frozenset[int], NoDecode] = Field(default_factory=frozenset)
+    ALLOWED_THREADS_IDS: Annotated[frozenset[int], NoDecode] = Field(default_factory=frozenset)
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
     SYSTEM_TEMPLATE: str = """Ответь на вопрос используя следующий контекст:
 {context}
 
@@ -25,5 +26,12 @@ class Config(BaseSettings):
 Чтобы вставлять ссылки, которые не содержут базовый адрес (например ссылка вида '/hello-world'), добавляй https://priem.mirea.ru.
 """
 
+    @field_validator("ALLOWED_CHAT_IDS", "ALLOWED_THREADS_IDS", mode="before")
+    @classmethod
+    def parse_ids(cls, value):
+        if isinstance(value, str):
+            return frozenset(int(item) for item in value.split(",") if item.strip())
+        return value
+
 
 config = Config()
@@ -1,5 +1,5 @@
+import asyncio
 from abc import ABC, abstractmethod
-from datetime import datetime
 
 import aiosqlite
 
@@ -9,6 +9,10 @@ class DatabaseHandler(ABC):
     async def initialize(self):
         pass
 
+    @abstractmethod
+    async def close(self):
+        pass
+
     @abstractmethod
     async def store_response(self, message_id: int, response: str):
         pass
@@ -25,102 +29,96 @@ class DatabaseHandler(ABC):
 class SQLiteHandler(DatabaseHandler):
     def __init__(self, db_path="feedback2.db"):
         self.db_path = db_path
+        self._db = None
+        self._write_lock = asyncio.Lock()
 
     async def initialize(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS feedback (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_id INTEGER,
-                    response TEXT,
-                    useful_count INTEGER DEFAULT 0,
-                    not_useful_count INTEGER DEFAULT 0,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS feedback (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id INTEGER,
+                response TEXT,
+                useful_count INTEGER DEFAULT 0,
+                not_useful_count INTEGER DEFAULT 0,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS user_feedback (
-                    feedback_id INTEGER,
-                    user_id INTEGER,
-                    feedback TEXT,
-                    UNIQUE(feedback_id, user_id),
-                    FOREIGN KEY(feedback_id) REFERENCES feedback(id)
-                )
-                """
+            """
+        )
+        await self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_feedback (
+                feedback_id INTEGER,
+                user_id INTEGER,
+                feedback TEXT,
+                UNIQUE(feedback_id, user_id),
+                FOREIGN KEY(feedback_id) REFERENCES feedback(id)
             )
-            await db.commit()
+            """
+        )
+        await self._db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_message_id ON feedback(message_id)")
+        await self._db.execute("CREATE INDEX IF NOT EXISTS idx_feedback_timestamp ON feedback(timestamp)")
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
 
     async def store_response(self, message_id: int, response: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
+        async with self._write_lock:
+            await self._db.execute(
                 "INSERT INTO feedback (message_id, response) VALUES (?, ?)",
                 (message_id, response),
             )
-            await db.commit()
+            await self._db.commit()
 
     async def update_feedback(self, message_id: int, user_id: int, feedback: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT id, useful_count, not_useful_count FROM feedback WHERE message_id = ?", (message_id,)
-            )
-            feedback_data = await cursor.fetchone()
-            if not feedback_data:
-                return
-
-            feedback_id, useful_count, not_useful_count = feedback_data
-
-            cursor = await db.execute(
-                "SELECT feedback FROM user_feedback WHERE feedback_id = ? AND user_id = ?", (feedback_id, user_id)
-            )
-            user_feedback = await cursor.fetchone()
-
-            if user_feedback:
-                if user_feedback[0] == feedback:
-                    return  # No change in feedback
-                # Remove the previous feedback count
-                if user_feedback[0] == "like":
-                    useful_count -= 1
-                else:
-                    not_useful_count -= 1
-
-            # Update the feedback count
-            if feedback == "like":
-                useful_count += 1
-            else:
-                not_useful_count += 1
-
-            await db.execute(
-                "INSERT OR REPLACE INTO user_feedback (feedback_id, user_id, feedback) VALUES (?, ?, ?)",
-                (feedback_id, user_id, feedback),
-            )
-            await db.execute(
-                "UPDATE feedback SET useful_count = ?, not_useful_count = ? WHERE id = ?",
-                (useful_count, not_useful_count, feedback_id),
-            )
-            await db.commit()
+        async with self._write_lock:
+            async with self._db.execute(
+                """
+                INSERT INTO user_feedback (feedback_id, user_id, feedback)
+                SELECT id, ?, ? FROM feedback WHERE message_id = ? ORDER BY id LIMIT 1
+                ON CONFLICT(feedback_id, user_id) DO UPDATE SET feedback = excluded.feedback
+                WHERE user_feedback.feedback != excluded.feedback
+                """,
+                (user_id, feedback, message_id),
+            ) as cursor:
+                changed = cursor.rowcount > 0
+
+            # Recount only when the user's feedback actually changed
+            if changed:
+                await self._db.execute(
+                    """
+                    UPDATE feedback SET
+                        useful_count = (
+                            SELECT COUNT(*) FROM user_feedback WHERE feedback_id = feedback.id AND feedback = 'like'
+                        ),
+                        not_useful_count = (
+                            SELECT COUNT(*) FROM user_feedback WHERE feedback_id = feedback.id AND feedback = 'dislike'
+                        )
+                    WHERE message_id = ?
+                    """,
+                    (message_id,),
+                )
+            await self._db.commit()
 
     async def get_feedback(self, message_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT useful_count, not_useful_count, response FROM feedback WHERE message_id = ?", (message_id,)
-            )
-            result = await cursor.fetchone()
-        return result
+        async with self._db.execute(
+            "SELECT useful_count, not_useful_count, response FROM feedback WHERE message_id = ?", (message_id,)
+        ) as cursor:
+            return await cursor.fetchone()
 
     async def get_overall_feedback_stats(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT SUM(useful_count), SUM(not_useful_count) FROM feedback")
-            result = await cursor.fetchone()
-        return result
+        async with self._db.execute("SELECT SUM(useful_count), SUM(not_useful_count) FROM feedback") as cursor:
+            return await cursor.fetchone()
 
     async def get_today_feedback_stats(self):
-        today = datetime.now().strftime("%Y-%m-%d")
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "SELECT SUM(useful_count), SUM(not_useful_count) FROM feedback WHERE DATE(timestamp) = ?", (today,)
-            )
-            result = await cursor.fetchone()
-        return result
+        async with self._db.execute(
+            "SELECT SUM(useful_count), SUM(not_useful_count) FROM feedback "
+            "WHERE timestamp >= date('now') AND timestamp < date('now', '+1 day')"
+        ) as cursor:
+            return await cursor.fetchone()
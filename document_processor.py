@@ -1,55 +1,98 @@
-import json
+import asyncio
+import hashlib
 import os
-import time
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-import html2text
-from bs4 import BeautifulSoup
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
+import chromadb
+import numpy as np
+import orjson
+import tiktoken
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import EncoderBackedStore, LocalFileStore
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
 from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
+from tenacity import RetryCallState, retry, stop_after_attempt, wait_exponential
 
+from page_extractor import PageExtractor
 from selenium_recursive_loader import SeleniumRecursiveLoader, default_page_ready_check
 
 
-class PageExtractor:
-    @staticmethod
-    def extract(html: str) -> str:
-        soup = BeautifulSoup(html, "html.parser")
-
-        for tag in ["header", "footer", "script", "style"]:
-            for elem in soup.find_all(tag):
-                elem.decompose()
+class EmbeddingsProvider:
+    CACHE_DIRECTORY = "./emb_cache"
+    # Half precision keeps cosine similarities within ~1e-4 of float32 at half the bytes
+    CACHE_DTYPE = np.float16
 
-        return html2text.html2text(str(soup)).strip()
+    @staticmethod
+    def create_embeddings(**kwargs) -> CacheBackedEmbeddings:
+        embeddings = OpenAIEmbeddings(**kwargs)
+        dtype = EmbeddingsProvider.CACHE_DTYPE
+        namespace = f"openai-{embeddings.model}-{np.dtype(dtype).name}"
+        # Vectors are keyed by the SHA-256 of their text and kept as raw floats instead of JSON-encoded ones
+        store = EncoderBackedStore[str, List[float]](
+            LocalFileStore(EmbeddingsProvider.CACHE_DIRECTORY),
+            key_encoder=lambda text: f"{namespace}/{hashlib.sha256(text.encode()).hexdigest()}",
+            value_serializer=lambda vector: np.asarray(vector, dtype=dtype).tobytes(),
+            value_deserializer=lambda data: np.frombuffer(data, dtype=dtype).astype(np.float32).tolist(),
+        )
+        return CacheBackedEmbeddings(embeddings, store, query_embedding_store=store)
 
 
 class DocumentStorage:
     def __init__(self, json_filepath: str):
         self.json_filepath = json_filepath
+        self.part_filepath = f"{json_filepath}.part"
 
-    def save_documents(self, documents: List[Document]):
-        with open(self.json_filepath, "w", encoding="utf-8") as f:
-            json.dump([doc.dict() for doc in documents], f, ensure_ascii=False, indent=4)
+    def save_pages(self, pages: Iterable[Tuple[Document, Set[str]]]):
+        # Pages are appended to the .part file as they arrive, together with their links, so an interrupted crawl
+        # can resume from it; documents_exist() only sees the file once the crawl has finished
+        with open(self.part_filepath, "ab") as f:
+            for doc, links in pages:
+                f.write(
+                    orjson.dumps(
+                        {"page_content": doc.page_content, "metadata": doc.metadata, "links": sorted(links)},
+                        option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS,
+                    )
+                )
+        os.replace(self.part_filepath, self.json_filepath)
 
-    def load_documents(self) -> List[Document]:
-        with open(self.json_filepath, "r", encoding="utf-8") as f:
-            documents_dicts = json.load(f)
-            return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in documents_dicts]
+    def load_partial_crawl(self) -> Dict[str, Set[str]]:
+        if not os.path.exists(self.part_filepath):
+            return {}
+        fetched = {}
+        complete_size = 0
+        with open(self.part_filepath, "r+b") as f:
+            for line in f:
+                # The interruption may have cut the last line short; it is dropped so that appending starts clean
+                if not line.endswith(b"\n"):
+                    break
+                page = orjson.loads(line)
+                fetched[page["metadata"]["source"]] = set(page["links"])
+                complete_size += len(line)
+            f.truncate(complete_size)
+        return fetched
+
+    def load_documents(self) -> Iterator[Document]:
+        with open(self.json_filepath, "rb") as f:
+            for line in f:
+                doc = orjson.loads(line)
+                yield Document(page_content=doc["page_content"], metadata=doc["metadata"])
 
     def documents_exist(self) -> bool:
         return os.path.exists(self.json_filepath)
 
 
 class DocumentFetcher:
-    def __init__(self, url: str, base_url: str, exclude_urls: List[str], page_extractor):
+    def __init__(self, url: str, base_url: str, exclude_urls: List[str], page_extractor, max_workers: int = 1):
         self.url = url
         self.base_url = base_url
         self.exclude_urls = exclude_urls
         self.page_extractor = page_extractor
+        self.max_workers = max_workers
 
-    def fetch_documents(self) -> List[Document]:
+    def fetch_pages(self, fetched: Dict[str, Set[str]]) -> Iterator[Tuple[Document, Set[str]]]:
         initial_links = [self.url]
         loader = SeleniumRecursiveLoader(
             urls=initial_links,
@@ -58,63 +101,181 @@ class DocumentFetcher:
             exclude_urls=self.exclude_urls,
             headless=False,
             page_ready_check=default_page_ready_check,
+            max_workers=self.max_workers,
         )
-        return loader.load()
+        return loader.iter_pages(fetched)
 
 
 class DocumentProcessor:
     PERSIST_DIRECTORY = "./chroma_db"
+    COLLECTION_NAME = "langchain"
+    SEMANTIC_CACHE_COLLECTION_NAME = "semcache"
 
-    def __init__(self, text_splitter, document_storage: DocumentStorage, document_fetcher: DocumentFetcher):
-        self.text_splitter = text_splitter
+    def __init__(
+        self,
+        text_splitter_factory: Callable[[], TextSplitter],
+        document_storage: DocumentStorage,
+        document_fetcher: DocumentFetcher,
+    ):
+        self.text_splitter_factory = text_splitter_factory
         self.document_storage = document_storage
         self.document_fetcher = document_fetcher
 
-    def fetch_and_process_documents(self) -> List[Document]:
+    def fetch_and_process_documents(self) -> Iterable[Document]:
         if self.document_storage.documents_exist():
             print(f"Loading documents from {self.document_storage.json_filepath}")
             return self.document_storage.load_documents()
         else:
-            print(f"Fetching and processing documents from {self.document_fetcher.url}")
-            docs = self.document_fetcher.fetch_documents()
-            self.document_storage.save_documents(docs)
-            return docs
+            fetched = self.document_storage.load_partial_crawl()
+            if fetched:
+                print(f"Resuming the crawl of {self.document_fetcher.url}, {len(fetched)} pages already saved")
+            else:
+                print(f"Fetching and processing documents from {self.document_fetcher.url}")
+            self.document_storage.save_pages(self.document_fetcher.fetch_pages(fetched))
+            return self.document_storage.load_documents()
+
+    def split_documents(self, documents: Iterable[Document], max_workers: Optional[int] = None) -> List[Document]:
+        # The tiktoken-backed splitter is not picklable, so every worker builds its own from the factory
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_split_worker,
+            initargs=(self.text_splitter_factory,),
+        ) as executor:
+            chunks = executor.map(_split_in_worker, ([doc] for doc in documents), chunksize=32)
+            return [chunk for document_chunks in chunks for chunk in document_chunks]
 
-    def process_documents_to_vectorstore(
+    @staticmethod
+    def deduplicate_documents(documents: Iterable[Document]) -> List[Document]:
+        # Navigation and footer fragments repeat across pages; each distinct text only needs to be embedded once
+        seen = set()
+        unique = []
+        for doc in documents:
+            digest = _content_hash(doc.page_content)
+            if digest not in seen:
+                seen.add(digest)
+                unique.append(doc)
+        return unique
+
+    async def process_documents_to_vectorstore_async(
         self,
         docs: List[Document],
         persist_directory: str,
         max_retries: int = 10,
         retry_delay: int = 60,
+        batch_size: int = 512,
+        max_concurrency: int = 16,
+        max_batch_tokens: int = 250_000,
     ):
-        for splitted_document in docs:
-            for attempt in range(max_retries):
+        embeddings = EmbeddingsProvider.create_embeddings(
+            chunk_size=batch_size,
+            retry_max_seconds=120,
+            retry_min_seconds=retry_delay,
+            max_retries=max_retries,
+            show_progress_bar=True,
+        )
+        # One client for the whole run; the vectors are computed here, so the collection needs no embedding function
+        client = chromadb.PersistentClient(path=persist_directory)
+        collection = client.get_or_create_collection(DocumentProcessor.COLLECTION_NAME, embedding_function=None)
+        embed_documents = retry(
+            stop=stop_after_attempt(max_retries),
+            wait=wait_exponential(max=retry_delay),
+            before_sleep=_log_retry,
+            reraise=True,
+        )(embeddings.aembed_documents)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Chunks are stored under their content hash, which must be unique within each upsert
+        docs = self.deduplicate_documents(docs)
+        # Similar-length chunks in one batch keep the slowest item from dominating every request
+        docs, token_counts = _sort_by_token_length(docs)
+        # OpenAI rejects embedding requests above 300k tokens, so batches are capped by tokens as well as by size
+        batches = _batch_by_token_budget(docs, token_counts, batch_size, max_batch_tokens)
+
+        async def add_batch(start: int, batch: List[Document]):
+            texts = [doc.page_content for doc in batch]
+            async with semaphore:
                 try:
-                    vectorstore = Chroma.from_documents(
-                        documents=[splitted_document],
-                        embedding=OpenAIEmbeddings(
-                            retry_max_seconds=120,
-                            retry_min_seconds=retry_delay,
-                            max_retries=max_retries,
-                            show_progress_bar=True,
-                        ),
-                        persist_directory=persist_directory,
-                    )
-                    print(f"Document {splitted_document.metadata['source']} successfully processed.")
-                    break
+                    vectors = await embed_documents(texts)
                 except Exception as e:
-                    print(f"Attempt {attempt + 1} failed with error: {e}")
-                    if attempt < max_retries - 1:
-                        print(f"Retrying in {retry_delay} seconds...")
-                        time.sleep(retry_delay)
-                    else:
-                        print("Max retries reached. Giving up.")
+                    print(f"Max retries reached for documents {start + 1}-{start + len(batch)}. Giving up: {e}")
+                    return
+
+            # Content-hash ids make reruns replace chunks in place instead of adding them again
+            collection.upsert(
+                ids=[_content_hash(text) for text in texts],
+                embeddings=vectors,
+                documents=texts,
+                metadatas=[doc.metadata for doc in batch],
+            )
+            print(f"Documents {start + 1}-{start + len(batch)} of {len(docs)} successfully processed.")
+
+        await asyncio.gather(*(add_batch(start, batch) for start, batch in batches))
+
+        # Cached answers (refusals included) were produced from the previous knowledge base; the bot recreates
+        # the semantic cache collection empty on its next start
+        try:
+            client.delete_collection(DocumentProcessor.SEMANTIC_CACHE_COLLECTION_NAME)
+        except ValueError:
+            pass
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _log_retry(retry_state: RetryCallState):
+    print(f"Attempt {retry_state.attempt_number} failed with error: {retry_state.outcome.exception()}")
+    print(f"Retrying in {retry_state.next_action.sleep:.0f} seconds...")
+
+
+@lru_cache(maxsize=None)
+def _get_token_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _sort_by_token_length(docs: List[Document]) -> Tuple[List[Document], List[int]]:
+    tokens = _get_token_encoding().encode_ordinary_batch([doc.page_content for doc in docs])
+    order = sorted(range(len(docs)), key=lambda i: len(tokens[i]))
+    return [docs[i] for i in order], [len(tokens[i]) for i in order]
+
+
+def _batch_by_token_budget(
+    docs: List[Document], token_counts: List[int], batch_size: int, max_batch_tokens: int
+) -> List[Tuple[int, List[Document]]]:
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, count in enumerate(token_counts):
+        if i > start and (i - start == batch_size or batch_tokens + count > max_batch_tokens):
+            batches.append((start, docs[start:i]))
+            start, batch_tokens = i, 0
+        batch_tokens += count
+    if start < len(docs):
+        batches.append((start, docs[start:]))
+    return batches
+
+
+def create_text_splitter() -> TextSplitter:
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base", chunk_size=2000, chunk_overlap=200
+    )
+
+
+_worker_text_splitter: Optional[TextSplitter] = None
+
+
+def _init_split_worker(text_splitter_factory: Callable[[], TextSplitter]):
+    global _worker_text_splitter
+    _worker_text_splitter = text_splitter_factory()
+
+
+def _split_in_worker(documents: List[Document]) -> List[Document]:
+    return _worker_text_splitter.split_documents(documents)
 
 
 # Usage example:
 if __name__ == "__main__":
     url = "https://vika-it.rtuitlab.dev/"
-    json_filepath = "documents.json"
+    json_filepath = "documents.jsonl"
     base_url = "https://vika-it.rtuitlab.dev"
     exclude_urls = [
         "https://priem.mirea.ru/lk/",
@@ -128,15 +289,11 @@ if __name__ == "__main__":
         "https://priem.mirea.ru/olymp-landing/",
     ]
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200).from_tiktoken_encoder(
-        encoding_name="cl100k_base", chunk_size=2000, chunk_overlap=200
-    )
-
     document_storage = DocumentStorage(json_filepath)
     page_extractor = PageExtractor.extract
-    document_fetcher = DocumentFetcher(url, base_url, exclude_urls, page_extractor)
-    processor = DocumentProcessor(text_splitter, document_storage, document_fetcher)
+    document_fetcher = DocumentFetcher(url, base_url, exclude_urls, page_extractor, max_workers=4)
+    processor = DocumentProcessor(create_text_splitter, document_storage, document_fetcher)
 
     documents = processor.fetch_and_process_documents()
-    documents = processor.text_splitter.split_documents(documents)
-    processor.process_documents_to_vectorstore(documents, DocumentProcessor.PERSIST_DIRECTORY)
+    documents = processor.split_documents(documents)
+    asyncio.run(processor.process_documents_to_vectorstore_async(documents, DocumentProcessor.PERSIST_DIRECTORY))
@@ -1,5 +1,6 @@
 import asyncio
 
+import uvloop
 from telegram.ext import Application, CallbackQueryHandler, CommandHandler
 
 from chatbot import ChatBot
@@ -38,7 +39,9 @@ async def main() -> None:
         except KeyboardInterrupt:
             await application.updater.stop()
             await application.stop()
+        finally:
+            await db_handler.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
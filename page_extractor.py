@@ -0,0 +1,64 @@
+import re
+from typing import List
+
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+
+
+class PageExtractor:
+    BLOCK_TAGS = frozenset(
+        {
+            "address", "article", "aside", "blockquote", "br", "dd", "details", "div", "dl", "dt", "figcaption",
+            "figure", "form", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "li", "main", "nav", "ol", "p", "pre",
+            "section", "summary", "table", "td", "th", "tr", "ul",
+        }
+    )  # fmt: skip
+    WHITESPACE_PATTERN = re.compile(r"\s+")
+
+    @staticmethod
+    def extract(tree: LexborHTMLParser) -> str:
+        tree.strip_tags(["header", "footer", "script", "style"])
+
+        # The prompt asks the model to cite sources, so links are kept inline in Markdown form
+        for link in tree.css("a[href]"):
+            href = link.attributes["href"]
+            text = " ".join(link.text(separator=" ").split())
+            if href and text:
+                link.replace_with(f"[{text}]({href})")
+
+        if tree.body is None:
+            return ""
+        return PageExtractor._render_text(tree.body)
+
+    @staticmethod
+    def _render_text(body: LexborNode) -> str:
+        # Line breaks go only between block elements, so inline tags do not split sentences. The walk uses an
+        # explicit stack because some pages nest elements deeper than Python's recursion limit
+        blocks = []
+        inline = []
+        stack = [body]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                PageExtractor._flush_inline(inline, blocks)
+            elif node.tag == "-text":
+                inline.append(node.text_content)
+            elif node.tag == "pre":
+                # Code listings and preformatted tables keep their own line breaks and indentation
+                PageExtractor._flush_inline(inline, blocks)
+                text = node.text(separator="").strip("\n")
+                if text.strip():
+                    blocks.append(text)
+            else:
+                if node.tag in PageExtractor.BLOCK_TAGS:
+                    PageExtractor._flush_inline(inline, blocks)
+                    stack.append(None)  # Closes the block once its children are rendered
+                stack.extend(reversed(list(node.iter(include_text=True))))
+        PageExtractor._flush_inline(inline, blocks)
+        return "\n".join(blocks)
+
+    @staticmethod
+    def _flush_inline(inline: List[str], blocks: List[str]):
+        text = PageExtractor.WHITESPACE_PATTERN.sub(" ", "".join(inline)).strip()
+        inline.clear()
+        if text:
+            blocks.append(text)
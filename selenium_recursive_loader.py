@@ -1,14 +1,18 @@
-from typing import Callable, List, Optional
-from urllib.parse import urljoin
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.util import Finalize
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-import html2text
-from bs4 import BeautifulSoup
 from langchain_core.documents import Document
+from selectolax.lexbor import LexborHTMLParser
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service as ChromeService
-from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from webdriver_manager.chrome import ChromeDriverManager
+from webdriver_manager.core.driver_cache import DriverCacheManager
+
+from page_extractor import PageExtractor
 
 
 class SeleniumRecursiveLoader:
@@ -19,21 +23,31 @@ class SeleniumRecursiveLoader:
         urls (List[str]): Initial list of URLs to start loading.
         base_url (str): The base URL for normalizing relative links.
         page_ready_check (Optional[Callable[[webdriver.Chrome], bool]]): An optional function to check if the page is ready.
-        page_extractor (Callable[[str], str]): A function to extract content from the page's raw HTML.
+        page_extractor (Callable[[LexborHTMLParser], str]): A function to extract content from the parsed page.
         exclude_urls (List[str]): List of URLs to exclude from loading.
         headless (bool): Flag to run the browser in headless mode.
+        max_workers (int): Number of worker processes, each with its own browser.
     """
 
+    BLOCKED_CONTENT_PREFS = {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.managed_default_content_settings.fonts": 2,
+        "profile.managed_default_content_settings.plugins": 2,
+        "profile.managed_default_content_settings.media_stream": 2,
+    }
+
     def __init__(
         self,
         urls: List[str],
         base_url: str,
-        page_extractor: Callable[[str], str],
+        page_extractor: Callable[[LexborHTMLParser], str] = PageExtractor.extract,
         page_ready_check: Optional[Callable[[webdriver.Chrome], bool]] = None,
         exclude_urls: List[str] = [],
         headless: bool = True,
         max_depth: int = 2,
         user_agent: str = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36",
+        max_workers: int = 1,
     ):
         """
         Initializes the SeleniumRecursiveLoader with the provided parameters.
@@ -41,21 +55,29 @@ class SeleniumRecursiveLoader:
         Args:
             urls (List[str]): Initial list of URLs to start loading.
             base_url (str): The base URL for normalizing relative links.
-            page_extractor (Callable[[str], str]): A function to extract content from the page's raw HTML.
+            page_extractor (Callable[[LexborHTMLParser], str], optional): A function to extract content from the parsed page. Defaults to PageExtractor.extract.
             page_ready_check (Optional[Callable[[webdriver.Chrome], bool]], optional): An optional function to check if the page is ready. Defaults to None.
             exclude_urls (List[str], optional): List of URLs to exclude from loading. Defaults to [].
             headless (bool, optional): Flag to run the browser in headless mode. Defaults to True.
             max_depth (int, optional): Maximum depth for recursive loading. Defaults to 2.
             user_agent (str, optional): Custom user agent string for the browser. Defaults to a standard user agent.
+            max_workers (int, optional): Number of worker processes, each with its own browser. Defaults to 1.
         """
-        self._urls = urls
+        # Seeds follow the same trailing-slash rule as harvested links, so "/" is not crawled a second time
+        self._urls = [url.rstrip("/") for url in urls]
         self._base_url = base_url.rstrip("/")
-        self._page_ready_check = page_ready_check or (lambda d: True)
+        self._base_url_slash = self._base_url + "/"
+        self._page_ready_check = page_ready_check or _no_loading_check
         self._page_extractor = page_extractor
-        self._exclude_urls = [url.rstrip("/") for url in exclude_urls]
+        # A single anchored pattern: the URL must start with the base URL and with none of the excluded prefixes
+        excluded = "|".join(re.escape(url.rstrip("/")) for url in exclude_urls)
+        self._url_filter = re.compile(
+            f"(?!{excluded}){re.escape(self._base_url)}" if excluded else re.escape(self._base_url)
+        )
         self._headless = headless
         self._max_depth = max_depth
         self._user_agent = user_agent
+        self._max_workers = max_workers
         self._driver = None
         self._visited_urls = set()
 
@@ -66,9 +88,16 @@ class SeleniumRecursiveLoader:
             options.add_argument("--headless")
         options.add_argument("--disable-blink-features=AutomationControlled")
         options.add_argument(f"user-agent={self._user_agent}")
+        # Only the HTML is extracted, so skip downloading everything that is merely rendered
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--disable-gpu")
+        options.add_experimental_option("prefs", self.BLOCKED_CONTENT_PREFS)
         options.add_experimental_option("excludeSwitches", ["enable-automation"])
         options.add_experimental_option("useAutomationExtension", False)
-        driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()), options=options)
+        # Return after DOMContentLoaded; the page ready check covers anything rendered later
+        options.page_load_strategy = "eager"
+        driver = webdriver.Chrome(service=ChromeService(_get_chrome_driver_path()), options=options)
         return driver
 
     def load(self) -> List[Document]:
@@ -78,47 +107,139 @@ class SeleniumRecursiveLoader:
         Returns:
             List[Document]: A list of Document objects with extracted content.
         """
+        return list(self.iter_load())
+
+    def iter_load(self) -> Iterator[Document]:
+        """
+        Starts the loading process for all initial URLs and yields each document as soon as its page is extracted.
+
+        Yields:
+            Document: A Document object with extracted content.
+        """
+        for document, _ in self.iter_pages():
+            yield document
+
+    def iter_pages(self, fetched: Optional[Dict[str, Set[str]]] = None) -> Iterator[Tuple[Document, Set[str]]]:
+        """
+        Starts the loading process for all initial URLs and yields each page as soon as it is extracted.
+
+        Args:
+            fetched (Optional[Dict[str, Set[str]]], optional): Links of the pages saved by an earlier, interrupted crawl.
+                These pages are not loaded again, but their links are still followed. Defaults to None.
+
+        Yields:
+            Tuple[Document, Set[str]]: The extracted document and the normalized links found on the page.
+        """
+        fetched = fetched or {}
+        if self._max_workers > 1:
+            yield from self._crawl_parallel(self._urls, fetched)
+            return
+
         self._driver = self._init_driver()
-        documents = []
-        for url in self._urls:
-            documents.extend(self._load_url_recursive(url))
-        self.close()
-        return documents
+        try:
+            yield from self._crawl(self._urls, fetched)
+        finally:
+            self.close()
 
-    def _load_url_recursive(self, url: str, depth: int = 0) -> List[Document]:
+    def _crawl(self, seeds: List[str], fetched: Dict[str, Set[str]]) -> Iterator[Tuple[Document, Set[str]]]:
         """
-        Recursively loads a URL and extracts its content and linked pages.
+        Crawls the given URLs and their linked pages breadth-first in the current driver.
 
         Args:
-            url (str): The URL to load.
-            depth (int, optional): Current recursion depth. Defaults to 0.
+            seeds (List[str]): The URLs to start crawling from.
+            fetched (Dict[str, Set[str]]): Links of the pages that are already saved and are not loaded again.
+
+        Yields:
+            Tuple[Document, Set[str]]: The extracted document and the normalized links found on the page.
+        """
+        frontier = deque((url, 0) for url in seeds)
+        while frontier:
+            url, depth = frontier.popleft()
+            if not self._should_visit(url, depth):
+                continue
+            self._visited_urls.add(url)
+
+            if url in fetched:
+                frontier.extend((link, depth + 1) for link in fetched[url] if link not in self._visited_urls)
+                continue
+            document, links = self._fetch_page(url)
+            frontier.extend((link, depth + 1) for link in links if link not in self._visited_urls)
+            yield document, links
+
+    def _crawl_parallel(self, seeds: List[str], fetched: Dict[str, Set[str]]) -> Iterator[Tuple[Document, Set[str]]]:
+        """
+        Crawls the given URLs breadth-first, fetching pages in a pool of worker processes.
+
+        Every worker drives its own browser, while the visited set and the frontier stay in this process.
+
+        Args:
+            seeds (List[str]): The URLs to start crawling from.
+            fetched (Dict[str, Set[str]]): Links of the pages that are already saved and are not loaded again.
+
+        Yields:
+            Tuple[Document, Set[str]]: The extracted document and the normalized links found on the page.
+        """
+        # Resolve the driver before forking so that the workers inherit the cached path
+        _get_chrome_driver_path()
+
+        frontier = deque((url, 0) for url in seeds)
+        pending = {}
+        with ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            initializer=_init_worker,
+            initargs=(self,),
+        ) as executor:
+            while frontier or pending:
+                while frontier:
+                    url, depth = frontier.popleft()
+                    if not self._should_visit(url, depth):
+                        continue
+                    self._visited_urls.add(url)
+                    if url in fetched:
+                        frontier.extend((link, depth + 1) for link in fetched[url] if link not in self._visited_urls)
+                        continue
+                    pending[executor.submit(_fetch_page_in_worker, url)] = depth
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = pending.pop(future)
+                    document, links = future.result()
+                    frontier.extend((link, depth + 1) for link in links if link not in self._visited_urls)
+                    yield document, links
+
+    def _should_visit(self, url: str, depth: int) -> bool:
+        """
+        Checks whether a URL is within the crawl limits and has not been visited yet.
+
+        Args:
+            url (str): The URL to check.
+            depth (int): Depth at which the URL was found.
 
         Returns:
-            List[Document]: A list of Document objects with extracted content.
+            bool: True if the URL should be loaded, False otherwise.
+        """
+        return depth <= self._max_depth and url not in self._visited_urls and self._url_filter.match(url) is not None
+
+    def _fetch_page(self, url: str) -> Tuple[Document, Set[str]]:
         """
-        if (
-            depth > self._max_depth
-            or not url.startswith(self._base_url)
-            or any(url.startswith(exclude) for exclude in self._exclude_urls)
-            or url in self._visited_urls
-        ):
-            return []
+        Loads a single page in the current driver and extracts its content and links.
 
-        self._visited_urls.add(url)
+        Args:
+            url (str): The URL to load.
 
+        Returns:
+            Tuple[Document, Set[str]]: The extracted document and the normalized links found on the page.
+        """
         self._driver.get(url)
         WebDriverWait(self._driver, 10).until(lambda d: not self._page_ready_check(d))
-        raw_html = self._driver.page_source
-        content = self._page_extractor(raw_html)
-        documents = [Document(page_content=content, metadata={"source": url})]
-
-        soup = BeautifulSoup(raw_html, "html.parser")
-        links = {self._normalize_url(a["href"]) for a in soup.find_all("a", href=True)}
-        for link in links:
-            if link:
-                documents.extend(self._load_url_recursive(link, depth + 1))
+        # Parse once: links are collected before the extractor is allowed to modify the tree
+        tree = LexborHTMLParser(self._driver.page_source)
+        hrefs = [href for node in tree.css("a[href]") if (href := node.attributes["href"])]
+        content = self._page_extractor(tree)
+        document = Document(page_content=content, metadata={"source": url})
 
-        return documents
+        links = {link for link in map(self._normalize_url, hrefs) if link}
+        return document, links
 
     def _normalize_url(self, url: str) -> str:
         """
@@ -128,11 +249,12 @@ class SeleniumRecursiveLoader:
             url (str): The URL to normalize.
 
         Returns:
-            str: The normalized URL.
+            str: The normalized URL, or an empty string if the URL is outside the base URL.
         """
-        if url.startswith("/"):
-            return urljoin(self._base_url, url)
-        if url.startswith(self._base_url):
+        # Root-relative paths are simply appended to the base; protocol-relative "//host" URLs are not
+        if url[:1] == "/" and url[1:2] != "/":
+            return self._base_url + url.rstrip("/")
+        if url.startswith(self._base_url_slash):
             return url.rstrip("/")
         return ""
 
@@ -141,33 +263,56 @@ class SeleniumRecursiveLoader:
         self._driver.quit()
 
 
+_chrome_driver_path: Optional[str] = None
+
+
+def _get_chrome_driver_path() -> str:
+    """Resolves the ChromeDriver binary once per process, trusting webdriver-manager's cache for 30 days."""
+    global _chrome_driver_path
+    if _chrome_driver_path is None:
+        _chrome_driver_path = ChromeDriverManager(cache_manager=DriverCacheManager(valid_range=30)).install()
+    return _chrome_driver_path
+
+
+def _no_loading_check(driver: webdriver.Chrome) -> bool:
+    """Default page ready check that never reports the page as still loading."""
+    return False
+
+
+_worker_loader: Optional[SeleniumRecursiveLoader] = None
+
+
+def _init_worker(loader: SeleniumRecursiveLoader):
+    """Starts a browser for the loader copy owned by a worker process and quits it when the worker exits."""
+    global _worker_loader
+    _worker_loader = loader
+    _worker_loader._driver = _worker_loader._init_driver()
+    Finalize(None, _worker_loader.close, exitpriority=10)
+
+
+def _fetch_page_in_worker(url: str) -> Tuple[Document, Set[str]]:
+    """Fetches a single page with the worker's browser."""
+    return _worker_loader._fetch_page(url)
+
+
+_LOADING_CHECK_SCRIPT = """
+const text = document.body ? document.body.innerText : "";
+return text.includes("Пожалуйста, подождите! Идет загрузка...") || text.includes("Проверка браузера перед переходом");
+"""
+
+
 def default_page_ready_check(driver: webdriver.Chrome) -> bool:
     """
-    Checks if the page is ready based on specific text elements.
+    Checks if the page is still showing the loading or browser check placeholder.
 
     Args:
         driver (webdriver.Chrome): The Selenium WebDriver instance.
 
     Returns:
-        bool: True if the page is ready, False otherwise.
+        bool: True if the page is still loading, False otherwise.
     """
+    # One script round-trip searching the rendered text, instead of an XPath scan plus a full page_source transfer
     try:
-        loading_text = driver.find_element(By.XPATH, "//*[contains(text(), 'Пожалуйста, подождите! Идет загрузка...')]")
-        ddos_guard_text = "ddos" in driver.page_source.lower()
-        return loading_text is not None or ddos_guard_text is not None
+        return bool(driver.execute_script(_LOADING_CHECK_SCRIPT))
     except Exception:
         return False
-
-
-def default_page_extractor(html: str) -> str:
-    """
-    Extracts and converts the HTML content to text.
-
-    Args:
-        html (str): Raw HTML content.
-
-    Returns:
-        str: Extracted text content.
-    """
-    soup = BeautifulSoup(html, "html.parser")
-    return html2text.html2text(soup.prettify()).strip()